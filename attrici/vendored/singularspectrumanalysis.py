@@ -8,10 +8,17 @@ Code for Singular Spectrum Analysis vendored from
 # License: BSD-3-Clause
 ```
 
-The code was included with minor modifications to simplify installation
-and work around memory issues on some systems.
-
-See <https://github.com/ISI-MIP/attrici/pull/102>
+The code was originally included with minor modifications to simplify
+installation and work around memory issues on some systems, see
+<https://github.com/ISI-MIP/attrici/pull/102>.
+
+Since then the numerical core has been rewritten and no longer matches
+upstream pyts line by line. The elementary matrices are kept in factored
+form (eigenvectors and their projections of the trajectory matrix) and
+diagonal averaging is done by FFT hankelization of these factors, grouped
+in the frequency domain. On top of the pyts interface, truncated
+eigensolvers (`eigen_solver`), the `dtype` and `n_jobs` options and
+`SingularSpectrumAnalysis.transform_batch` were added.
 
 Tests from pyts for the SSA are also vendored in `tests/test_vendored_ssa.py`.
 """
@@ -47,45 +54,126 @@ Tests from pyts for the SSA are also vendored in `tests/test_vendored_ssa.py`.
 # Author: Johann Faouzi <johann.faouzi@gmail.com>
 # License: BSD-3-Clause
 
+from functools import lru_cache
 from math import ceil
 
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
+from joblib import Parallel, delayed, effective_n_jobs
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import linalg
+from scipy.fft import irfft, next_fast_len, rfft
 
 
-def _outer_dot(v, X, n_samples, window_size, n_windows):
-    """Outer Dot."""
-    X_new = np.empty((n_samples, window_size, window_size, n_windows))
-    for i in range(n_samples):
-        for j in range(window_size):
-            X_new[i, j] = np.dot(np.outer(v[i, :, j], v[i, :, j]), X[i])
-    return X_new
+def _hankelize_fft(U, V, n_timestamps, groups_mask=None):
+    """
+    Anti-diagonal sums of the rank-one matrices ``U[..., :, None] * V[..., None, :]``.
 
+    The sums are the linear convolutions of ``U`` and ``V`` along the last axis,
+    computed with zero-padded real FFTs. If ``groups_mask`` is given, the
+    spectra of the rank-one matrices are summed with its weights before the
+    inverse FFT, so that only one sum per group is transformed back.
+    """
+    n_fft = next_fast_len(n_timestamps, real=True)
+    X_fft = rfft(U, n=n_fft, axis=-1) * rfft(V, n=n_fft, axis=-1)
+    if groups_mask is not None:
+        X_fft = np.matmul(groups_mask, X_fft)
+    return irfft(X_fft, n=n_fft, axis=-1)[..., :n_timestamps]
+
+
+def _hankelize_direct(U, V, n_timestamps, groups_mask=None):
+    """
+    Anti-diagonal sums of the rank-one matrices ``U[..., :, None] * V[..., None, :]``.
 
-def _diagonal_averaging(
-    X, n_samples, n_timestamps, window_size, n_windows, grouping_size, gap
-):
-    """Diagonal Averaging."""
-    X_new = np.empty((n_samples, grouping_size, n_timestamps))
-    first_row = [(0, col) for col in range(n_windows)]
-    last_col = [(row, n_windows - 1) for row in range(1, window_size)]
-    indices = first_row + last_col
-    for i in range(n_samples):
-        for group in range(grouping_size):
-            for j, k in indices:
-                X_new[i, group, j + k] = np.diag(
-                    X[i, group, :, ::-1], gap - j - k - 1
-                ).mean()
+    The sums are accumulated as shifted, unit-stride slices of the longer
+    factor, one per element of the shorter factor. If ``groups_mask`` is given,
+    each slice is summed over the rank-one matrices with its weights first.
+    """
+    if U.shape[-1] > V.shape[-1]:
+        U, V = V, U
+    if groups_mask is None:
+        shape = np.broadcast_shapes(U.shape[:-1], V.shape[:-1])
+    else:
+        shape = groups_mask.shape[:-1]
+    X_new = np.zeros(shape + (n_timestamps,), dtype=np.result_type(U, V))
+    size = V.shape[-1]
+    for j in range(U.shape[-1]):
+        X_shift = U[..., j, None] * V
+        if groups_mask is not None:
+            X_shift = np.matmul(groups_mask, X_shift)
+        X_new[..., j : j + size] += X_shift
     return X_new
 
 
-def _windowed_view(X, n_samples, n_timestamps, window_size, window_step):
+def _hankelize(U, V, n_timestamps, groups_mask=None):
+    """Anti-diagonal sums, directly for short factors and by FFT otherwise."""
+    MAX_DIRECT_SIZE = 8
+    if min(U.shape[-1], V.shape[-1]) <= MAX_DIRECT_SIZE:
+        return _hankelize_direct(U, V, n_timestamps, groups_mask)
+    return _hankelize_fft(U, V, n_timestamps, groups_mask)
+
+
+def _diagonal_averaging(X, window_size, n_windows):
+    """Diagonal Averaging of the anti-diagonal sums ``X``."""
+    n_timestamps = window_size + n_windows - 1
+    weights = np.minimum.reduce(
+        [
+            np.arange(1, n_timestamps + 1, dtype=X.dtype),
+            np.arange(n_timestamps, 0, -1, dtype=X.dtype),
+            np.full(n_timestamps, min(window_size, n_windows), dtype=X.dtype),
+        ]
+    )
+    return X / weights
+
+
+def _randomized_eigh(X, n_components, n_oversamples=10, n_iter=4, random_state=0):
+    """
+    Leading eigenpairs of the symmetric matrices ``X`` by randomized subspace
+    iteration (Halko, Martinsson and Tropp), in ascending order like
+    ``np.linalg.eigh``.
+    """
+    rng = np.random.default_rng(random_state)
+    size = X.shape[-1]
+    Q = rng.standard_normal(
+        (size, min(n_components + n_oversamples, size)), dtype=X.dtype
+    )
+    Q, _ = np.linalg.qr(np.matmul(X, Q))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(np.matmul(X, Q))
+    B = np.matmul(np.transpose(Q, axes=(0, 2, 1)), np.matmul(X, Q))
+    w, v = np.linalg.eigh(B)
+    return w[:, -n_components:], np.matmul(Q, v[:, :, -n_components:])
+
+
+def _subset_eigh(X, n_components):
+    """
+    Leading eigenpairs of the symmetric matrices ``X`` by the MRRR driver of
+    LAPACK, in ascending order like ``np.linalg.eigh``.
+    """
+    size = X.shape[-1]
+    w = np.empty((X.shape[0], n_components), dtype=X.dtype)
+    v = np.empty((X.shape[0], size, n_components), dtype=X.dtype)
+    for i in range(X.shape[0]):
+        w[i], v[i] = linalg.eigh(
+            X[i], subset_by_index=[size - n_components, size - 1], driver="evr"
+        )
+    return w, v
+
+
+@lru_cache
+def _periodogram_indices(window_size, lower_frequency_bound):
+    """
+    Indices of the last periodogram frequency below ``lower_frequency_bound``
+    and of the middle frequency for eigenvectors of length ``window_size``.
+    """
+    f = np.arange(0, 1 + window_size // 2) / window_size
+    idx_trend = int(np.flatnonzero(f < lower_frequency_bound)[-1])
+    idx_resid = len(f) // 2
+    return idx_trend, idx_resid
+
+
+def _windowed_view(X, window_size, window_step):
     """Windowed View."""
-    overlap = window_size - window_step
-    shape_new = (n_samples, (n_timestamps - overlap) // window_step, window_size // 1)
-    s0, s1 = X.strides
-    strides_new = (s0, window_step * s1, s1)
-    return as_strided(X, shape=shape_new, strides=strides_new)
+    return sliding_window_view(X, window_size, axis=1)[:, ::window_step]
 
 
 class SingularSpectrumAnalysis:
@@ -119,6 +207,27 @@ class SingularSpectrumAnalysis:
         residual components by considering the periodogram.
         It must be between 0 and 1. Ignored if 'groups' is not set to 'auto'.
 
+    eigen_solver : 'auto', 'dense', 'subset' or 'randomized' (default = 'auto')
+        The eigendecomposition of the lag-covariance matrix. If 'dense', all
+        eigenpairs are computed with ``np.linalg.eigh``. If 'subset', only
+        the leading eigenpairs used by ``groups`` are computed with
+        ``scipy.linalg.eigh(..., driver='evr')``, which is faster if
+        ``groups`` is array-like and uses few components. If 'randomized',
+        these eigenpairs are approximated by randomized subspace iteration,
+        which is faster still, but inaccurate if the leading eigenvalues are
+        close to each other. If 'auto', 'subset' is used if ``groups`` uses at
+        most a tenth of the components, otherwise 'dense'.
+
+    dtype : np.float32 or np.float64 (default = np.float64)
+        Floating point type used for all the computations and the output.
+        ``np.float32`` halves the memory traffic at the cost of precision.
+
+    n_jobs : None or int (default = None)
+        The number of threads used to transform blocks of samples in
+        parallel. None means 1 unless in a ``joblib.parallel_config``
+        context, -1 means using all processors. Note that NumPy may already
+        use several threads for its linear algebra.
+
     References
     ----------
     [1] N. Golyandina, and A. Zhigljavsky, "Singular Spectrum Analysis for
@@ -126,6 +235,10 @@ class SingularSpectrumAnalysis:
 
     [2] T. Alexandrov, "A Method of Trend Extraction Using Singular
            Spectrum Analysis", REVSTAT (2008).
+
+    [3] N. Halko, P. G. Martinsson, and J. A. Tropp, "Finding Structure with
+           Randomness: Probabilistic Algorithms for Constructing Approximate
+           Matrix Decompositions", SIAM Review (2011).
     """
 
     def __init__(
@@ -134,6 +247,10 @@ class SingularSpectrumAnalysis:
         groups=None,
         lower_frequency_bound=0.075,
         lower_frequency_contribution=0.85,
+        *,
+        eigen_solver="auto",
+        dtype=np.float64,
+        n_jobs=None,
     ):
         """
         Initialize the SSA.
@@ -148,11 +265,20 @@ class SingularSpectrumAnalysis:
             Lower bound for frequency filtering, by default 0.075.
         lower_frequency_contribution : float, optional
             Contribution of the lower frequency component, by default 0.85.
+        eigen_solver : str, optional
+            Eigendecomposition method, by default 'auto'.
+        dtype : np.float32 or np.float64, optional
+            Floating point type of the computation, by default np.float64.
+        n_jobs : int or None, optional
+            Number of threads for transforming the samples, by default None.
         """
         self.window_size = window_size
         self.groups = groups
         self.lower_frequency_bound = lower_frequency_bound
         self.lower_frequency_contribution = lower_frequency_contribution
+        self.eigen_solver = eigen_solver
+        self.dtype = dtype
+        self.n_jobs = n_jobs
 
     def transform(self, X):
         """
@@ -173,78 +299,131 @@ class SingularSpectrumAnalysis:
             the length of ``groups``. If ``n_splits=1``, ``X_new`` is squeezed
             and its shape is (n_samples, n_timestamps).
         """
+        return np.squeeze(self._transform(X))
+
+    def transform_batch(self, X, batch_size=64):
+        """
+        Transform the provided data in batches of samples.
+
+        The result is the same as for `transform`, but the samples (e.g. the
+        time series of many grid cells) are transformed in blocks of
+        ``batch_size``. The eigendecompositions and matrix products of a block
+        are single batched calls, while the memory of the intermediate arrays
+        is bounded by the block size.
+
+        Parameters
+        ----------
+        X : array-like, shape = (n_samples, n_timestamps)
+
+        batch_size : int (default = 64)
+            Number of samples transformed together.
+
+        Returns
+        -------
+        X_new : array-like, shape = (n_samples, n_splits, n_timestamps)
+            Transformed data, see `transform`.
+        """
+        if not isinstance(batch_size, (int, np.integer)) or batch_size < 1:
+            raise ValueError("'batch_size' must be a positive integer.")
+        X = np.ascontiguousarray(X, dtype=self.dtype)
+        if X.shape[0] == 0:
+            return np.squeeze(self._transform(X))
+        X_new = [
+            self._transform(X[i : i + batch_size])
+            for i in range(0, X.shape[0], batch_size)
+        ]
+        return np.squeeze(np.concatenate(X_new))
+
+    def _transform(self, X):
+        """Transform without squeezing the output."""
+        X = np.ascontiguousarray(X, dtype=self.dtype)
         n_samples, n_timestamps = X.shape
         window_size = self._check_params(n_timestamps)
+        n_jobs = min(effective_n_jobs(self.n_jobs), n_samples)
+        if n_jobs <= 1:
+            return self._transform_samples(X, window_size)
+        X_new = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(self._transform_samples)(X_split, window_size)
+            for X_split in np.array_split(X, n_jobs)
+        )
+        return np.concatenate(X_new)
+
+    def _transform_samples(self, X, window_size):
+        """Transform a block of samples."""
+        n_samples, n_timestamps = X.shape
         n_windows = n_timestamps - window_size + 1
 
-        X_window = np.transpose(
-            _windowed_view(X, n_samples, n_timestamps, window_size, window_step=1),
-            axes=(0, 2, 1),
-        ).copy()
-        X_tranpose = np.matmul(X_window, np.transpose(X_window, axes=(0, 2, 1)))
-        w, v = np.linalg.eigh(X_tranpose)
+        # A contiguous copy lets the products below use BLAS, which is faster
+        # than multiplying the overlapping strided view
+        X_window = np.ascontiguousarray(
+            np.swapaxes(_windowed_view(X, window_size, window_step=1), 1, 2)
+        )
+        X_tranpose = np.matmul(X_window, np.swapaxes(X_window, 1, 2))
+        if isinstance(self.groups, (list, tuple, np.ndarray)):
+            n_components = int(np.concatenate(self.groups).max(initial=-1)) + 1
+        else:
+            n_components = window_size
+        if n_components == 0:
+            # All the groups are empty
+            return np.zeros((n_samples, len(self.groups), n_timestamps), dtype=X.dtype)
+        eigen_solver = self.eigen_solver
+        if eigen_solver == "auto":
+            eigen_solver = "subset" if 10 * n_components <= window_size else "dense"
+        if eigen_solver == "subset":
+            w, v = _subset_eigh(X_tranpose, n_components)
+        elif eigen_solver == "randomized":
+            w, v = _randomized_eigh(X_tranpose, n_components)
+        else:
+            w, v = np.linalg.eigh(X_tranpose)
         w, v = w[:, ::-1], v[:, :, ::-1]
 
-        X_elem = _outer_dot(v, X_window, n_samples, window_size, n_windows)
-        X_groups, grouping_size = self._grouping(
-            X_elem, n_samples, window_size, n_windows, v
-        )
-        if window_size >= n_windows:
-            X_groups = np.transpose(X_groups, axes=(0, 1, 3, 2))
-            gap = window_size
+        if self.groups is None:
+            # Each elementary matrix is its own group
+            groups_mask = None
         else:
-            gap = n_windows
-
-        X_ssa = _diagonal_averaging(
-            X_groups,
-            n_samples,
-            n_timestamps,
-            window_size,
-            n_windows,
-            grouping_size,
-            gap,
-        )
-        return np.squeeze(X_ssa)
+            groups_mask = self._grouping(v, n_samples, window_size)
+            components = np.flatnonzero(groups_mask.any(axis=(0, 1)))
+            v, groups_mask = v[:, :, components], groups_mask[:, :, components]
+
+        v_transpose = np.transpose(v, axes=(0, 2, 1))
+        X_proj = np.matmul(v_transpose, X_window)
+        X_groups = _hankelize(v_transpose, X_proj, n_timestamps, groups_mask)
+        return _diagonal_averaging(X_groups, window_size, n_windows)
 
-    def _grouping(self, X, n_samples, window_size, n_windows, v):
+    def _grouping(self, v, n_samples, window_size):
         """Grouping."""
-        if self.groups is None:
-            grouping_size = window_size
-            X_new = X
-        elif self.groups == "auto":
-            grouping_size = 3
-            f = np.arange(0, 1 + window_size // 2) / window_size
-            Pxx = np.abs(np.fft.rfft(v, axis=1, norm="ortho")) ** 2
+        n_components = v.shape[-1]
+        if self.groups == "auto":
+            Pxx = np.abs(rfft(v, axis=1, norm="ortho")) ** 2
             if Pxx.shape[-1] % 2 == 0:
                 Pxx[:, 1:-1, :] *= 2
             else:
                 Pxx[:, 1:, :] *= 2
 
-            Pxx_cumsum = np.cumsum(Pxx, axis=1)
-            idx_trend = np.where(f < self.lower_frequency_bound)[0][-1]
-            idx_resid = Pxx_cumsum.shape[1] // 2
+            idx_trend, idx_resid = _periodogram_indices(
+                window_size, self.lower_frequency_bound
+            )
+            Pxx_total = Pxx.sum(axis=1)
+            Pxx_trend = Pxx[:, : idx_trend + 1].sum(axis=1)
+            Pxx_resid = Pxx[:, : idx_resid + 1].sum(axis=1)
 
             c = self.lower_frequency_contribution
-            trend = Pxx_cumsum[:, idx_trend, :] / Pxx_cumsum[:, -1, :] > c
-            resid = Pxx_cumsum[:, idx_resid, :] / Pxx_cumsum[:, -1, :] < c
+            trend = Pxx_trend / Pxx_total > c
+            resid = Pxx_resid / Pxx_total < c
             season = np.logical_and(~trend, ~resid)
 
-            X_new = np.zeros((n_samples, grouping_size, window_size, n_windows))
-            for i in range(n_samples):
-                for j, arr in enumerate((trend, season, resid)):
-                    X_new[i, j] = X[i, arr[i]].sum(axis=0)
+            groups_mask = np.stack((trend, season, resid), axis=1).astype(v.dtype)
         elif isinstance(self.groups, int):
             grouping = np.linspace(0, window_size, self.groups + 1).astype("int64")
-            grouping_size = len(grouping) - 1
-            X_new = np.zeros((n_samples, grouping_size, window_size, n_windows))
-            for i, (j, k) in enumerate(zip(grouping[:-1], grouping[1:])):
-                X_new[:, i] = X[:, j:k].sum(axis=1)
+            idx = np.arange(n_components)
+            groups_mask = (
+                (grouping[:-1, None] <= idx) & (idx < grouping[1:, None])
+            ).astype(v.dtype)
         else:
-            grouping_size = len(self.groups)
-            X_new = np.zeros((n_samples, grouping_size, window_size, n_windows))
+            groups_mask = np.zeros((len(self.groups), n_components), dtype=v.dtype)
             for i, group in enumerate(self.groups):
-                X_new[:, i] = X[:, group].sum(axis=1)
-        return X_new, grouping_size
+                np.add.at(groups_mask[i], group, 1)
+        return np.broadcast_to(groups_mask, (n_samples, *groups_mask.shape[-2:]))
 
     def _check_params(self, n_timestamps):
         """Check Params."""
@@ -290,6 +469,13 @@ class SingularSpectrumAnalysis:
                 "'lower_frequency_contribution' must be greater than 0 "
                 "and lower than 1."
             )
+        if np.dtype(self.dtype) not in (np.float32, np.float64):
+            raise ValueError("'dtype' must be either np.float32 or np.float64.")
+        if self.eigen_solver not in ("auto", "dense", "subset", "randomized"):
+            raise ValueError(
+                "'eigen_solver' must be either 'auto', 'dense', 'subset' or "
+                "'randomized'."
+            )
         if isinstance(self.groups, (int, np.integer)):
             if not 1 <= self.groups <= self.window_size:
                 raise ValueError(
@@ -41,39 +41,14 @@ import pytest
 from attrici.vendored.singularspectrumanalysis import (
     SingularSpectrumAnalysis,
     _diagonal_averaging,
-    _outer_dot,
+    _hankelize_direct,
+    _hankelize_fft,
 )
 
 rng = np.random.RandomState(42)
 X = rng.randn(4, 30)
 
 
-@pytest.mark.parametrize(
-    "v, X, arr_desired",
-    [
-        (np.zeros((2, 2, 2)), np.ones((2, 2, 2)), np.zeros((2, 2, 2, 2))),
-        (np.ones((2, 2, 2)), np.zeros((2, 2, 2)), np.zeros((2, 2, 2, 2))),
-        (
-            [[[1, 2], [3, 4]]],
-            np.ones((1, 2, 2)),
-            [[[[4, 4], [12, 12]], [[12, 12], [24, 24]]]],
-        ),
-        (
-            [[[1, 2], [3, 4]]],
-            [[[2, 1], [-2, -3]]],
-            [[[[-4, -8], [-12, -24]], [[-8, -20], [-16, -40]]]],
-        ),
-    ],
-)
-def test_outer_dot(v, X, arr_desired):
-    """Test that the actual results are the expected ones."""
-    v = np.asarray(v).astype("float64")
-    X = np.asarray(X).astype("float64")
-    n_samples, n_windows, window_size = X.shape
-    arr_actual = _outer_dot(v, X, n_samples, window_size, n_windows)
-    np.testing.assert_allclose(arr_actual, arr_desired, atol=1e-5, rtol=0.0)
-
-
 @pytest.mark.parametrize(
     "X, arr_desired",
     [
@@ -101,14 +76,48 @@ def test_diagonal_averaging(X, arr_desired):
     X = np.asarray(X, dtype="float64")
     n_samples, grouping_size, window_size, n_windows = X.shape
     n_timestamps = window_size + n_windows - 1
-    gap = max(n_windows, window_size)
 
-    arr_actual = _diagonal_averaging(
-        X, n_samples, n_timestamps, window_size, n_windows, grouping_size, gap
-    )
+    # Each matrix is the sum of the rank-one matrices e_j X[j] over its rows j
+    X_sums = _hankelize_fft(np.eye(window_size), X, n_timestamps).sum(axis=-2)
+    arr_actual = _diagonal_averaging(X_sums, window_size, n_windows)
     np.testing.assert_allclose(arr_actual, arr_desired, atol=1e-5, rtol=0.0)
 
 
+@pytest.mark.parametrize("window_size, n_windows", [(1, 5), (3, 7), (8, 4), (20, 20)])
+def test_hankelize(window_size, n_windows):
+    """Test that the direct and FFT anti-diagonal sums agree."""
+    n_timestamps = window_size + n_windows - 1
+    U = rng.randn(2, 3, window_size)
+    V = rng.randn(2, 3, n_windows)
+    arr_desired = np.array(
+        [
+            [np.convolve(U[i, j], V[i, j]) for j in range(U.shape[1])]
+            for i in range(U.shape[0])
+        ]
+    )
+    np.testing.assert_allclose(
+        _hankelize_direct(U, V, n_timestamps), arr_desired, atol=1e-8, rtol=0.0
+    )
+    np.testing.assert_allclose(
+        _hankelize_fft(U, V, n_timestamps), arr_desired, atol=1e-8, rtol=0.0
+    )
+
+    groups_mask = rng.rand(2, 2, 3)
+    arr_desired = np.matmul(groups_mask, arr_desired)
+    np.testing.assert_allclose(
+        _hankelize_direct(U, V, n_timestamps, groups_mask),
+        arr_desired,
+        atol=1e-8,
+        rtol=0.0,
+    )
+    np.testing.assert_allclose(
+        _hankelize_fft(U, V, n_timestamps, groups_mask),
+        arr_desired,
+        atol=1e-8,
+        rtol=0.0,
+    )
+
+
 @pytest.mark.parametrize(
     "params, error, err_msg",
     [
@@ -166,6 +175,21 @@ def test_diagonal_averaging(X, arr_desired):
             "If 'groups' is array-like, all the values in 'groups' must be integers "
             "between 0 and ('window_size' - 1).",
         ),
+        (
+            {"dtype": np.int64},
+            ValueError,
+            "'dtype' must be either np.float32 or np.float64.",
+        ),
+        (
+            {"dtype": np.float16},
+            ValueError,
+            "'dtype' must be either np.float32 or np.float64.",
+        ),
+        (
+            {"eigen_solver": "arpack"},
+            ValueError,
+            "'eigen_solver' must be either 'auto', 'dense', 'subset' or 'randomized'.",
+        ),
     ],
 )
 def test_parameter_check(params, error, err_msg):
@@ -192,6 +216,7 @@ def test_parameter_check(params, error, err_msg):
         ({"window_size": 5, "groups": "auto"}),
         ({"groups": "auto", "lower_frequency_contribution": 0.99}),
         ({"groups": "auto", "lower_frequency_bound": 0.01}),
+        ({"groups": "auto", "dtype": np.float32}),
     ],
 )
 def test_actual_results(params):
@@ -199,3 +224,80 @@ def test_actual_results(params):
     ssa = SingularSpectrumAnalysis(**params)
     arr_actual = ssa.transform(X).sum(axis=1)
     np.testing.assert_allclose(arr_actual, X, atol=1e-5, rtol=0.0)
+
+
+@pytest.mark.parametrize("groups", [[[]], [[], []], [[0], []]])
+def test_empty_groups(groups):
+    """Test that empty groups reconstruct to zeros."""
+    ssa = SingularSpectrumAnalysis(groups=groups)
+    arr_actual = ssa.transform(X).reshape(X.shape[0], len(groups), X.shape[1])
+    for i, group in enumerate(groups):
+        if not group:
+            np.testing.assert_array_equal(arr_actual[:, i], 0)
+
+
+@pytest.mark.parametrize(
+    "params, shape",
+    [
+        ({}, (0, 4, 30)),
+        ({"groups": "auto"}, (0, 3, 30)),
+        ({"groups": [[0, 1], [2, 3]], "n_jobs": 2}, (0, 2, 30)),
+    ],
+)
+def test_zero_samples(params, shape):
+    """Test that an input without samples gives an empty output."""
+    ssa = SingularSpectrumAnalysis(**params)
+    assert ssa.transform(X[:0]).shape == shape
+    assert ssa.transform_batch(X[:0]).shape == shape
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        ({"window_size": 4}),
+        ({"window_size": 12}),
+        ({"window_size": 12, "groups": "auto"}),
+        ({"window_size": 12, "groups": [[0], [1, 2]]}),
+    ],
+)
+def test_float32(params):
+    """Test that float32 is kept on the direct and the FFT paths."""
+    ssa = SingularSpectrumAnalysis(dtype=np.float32, **params)
+    assert ssa.transform(X).dtype == np.float32
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 4, 64])
+def test_transform_batch(batch_size):
+    """Test that transforming in batches gives the same results."""
+    ssa = SingularSpectrumAnalysis(window_size=6, groups="auto")
+    arr_actual = ssa.transform_batch(X, batch_size=batch_size)
+    np.testing.assert_allclose(arr_actual, ssa.transform(X), atol=1e-8, rtol=0.0)
+
+
+@pytest.mark.parametrize("n_jobs", [2, -1])
+def test_n_jobs(n_jobs):
+    """Test that transforming in parallel gives the same results."""
+    arr_desired = SingularSpectrumAnalysis(groups="auto").transform(X)
+    arr_actual = SingularSpectrumAnalysis(groups="auto", n_jobs=n_jobs).transform(X)
+    np.testing.assert_allclose(arr_actual, arr_desired, atol=1e-8, rtol=0.0)
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        ({"window_size": 50, "groups": [[0], [1, 2]]}),
+        ({"window_size": 20, "groups": 4}),
+    ],
+)
+@pytest.mark.parametrize("eigen_solver", ["auto", "subset", "randomized"])
+def test_eigen_solver(params, eigen_solver):
+    """Test that the truncated solvers match the dense one for a clear signal."""
+    t = np.arange(300)
+    X_signal = 0.01 * t + np.sin(2 * np.pi * t / 25) + 0.1 * rng.randn(2, 300)
+    arr_desired = SingularSpectrumAnalysis(eigen_solver="dense", **params).transform(
+        X_signal
+    )
+    arr_actual = SingularSpectrumAnalysis(
+        eigen_solver=eigen_solver, **params
+    ).transform(X_signal)
+    np.testing.assert_allclose(arr_actual, arr_desired, atol=1e-5, rtol=0.0)